@@ -0,0 +1,67 @@
+"""
+Launch an IPython kernel with resource limits and pre-imported libraries.
+
+Used as the argv of the python3 kernel spec of the Docker image (see
+docker/kernels/python3/kernel.json). Limits are read from the environment:
+
+    HOML3_KERNEL_MEM_LIMIT  max data memory of the kernel, e.g. 4G (unset: none)
+    HOML3_KERNEL_THREADS    threads for BLAS/OpenMP/TensorFlow (unset: all)
+    HOML3_KERNEL_PRELOAD    modules imported before the kernel starts
+                            (default: numpy,pandas,sklearn)
+"""
+
+import importlib
+import os
+import resource
+import sys
+
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                    "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS")
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size):
+    '''Parse a size such as 512M or 4G into bytes'''
+
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def set_limits():
+    '''Apply the memory and thread limits from the environment'''
+
+    mem_limit = os.environ.get("HOML3_KERNEL_MEM_LIMIT")
+    if mem_limit:
+        # RLIMIT_DATA (rather than RLIMIT_AS) caps the heap and anonymous
+        # mappings, i.e. the arrays, without breaking libraries such as
+        # TensorFlow that reserve large amounts of virtual address space
+        limit = parse_size(mem_limit)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+    threads = os.environ.get("HOML3_KERNEL_THREADS")
+    if threads:
+        # must be set before the libraries are imported
+        for variable in THREAD_VARIABLES:
+            os.environ.setdefault(variable, threads)
+
+
+def preload():
+    '''Import the HOML3_KERNEL_PRELOAD modules, so notebooks start warm'''
+
+    modules = os.environ.get("HOML3_KERNEL_PRELOAD", "numpy,pandas,sklearn")
+    for module in filter(None, (name.strip() for name in modules.split(","))):
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print(f"Could not preload {module}: {e}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    set_limits()
+    preload()
+
+    from ipykernel import kernelapp
+    kernelapp.launch_new_instance()
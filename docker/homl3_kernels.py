@@ -0,0 +1,230 @@
+"""
+Kernel management for the shared handson-ml3 Docker container.
+
+PooledKernelManager keeps a few pre-started kernels ready to be handed out
+(they import numpy/pandas/sklearn at startup, see homl3_kernel_launcher.py)
+and moves them to the session's directory and environment when claimed,
+never culls them while they wait, and records kernel startup latencies.
+Loaded as a server extension, this module also serves kernel memory and
+startup metrics as JSON at /homl3/metrics.
+"""
+
+import asyncio
+import collections
+import datetime
+import json
+import os
+import time
+
+from jupyter_server.base.handlers import APIHandler
+from jupyter_server.services.kernels.kernelmanager import AsyncMappingKernelManager
+from jupyter_server.utils import url_path_join
+from tornado import web
+from tornado.ioloop import IOLoop
+from traitlets import Integer, Unicode
+
+
+class PooledKernelManager(AsyncMappingKernelManager):
+    '''Kernel manager handing out pre-started kernels from a pool'''
+
+    pool_size = Integer(1, config=True,
+                        help="Number of idle kernels kept ready to be handed out.")
+    pool_kernel_name = Unicode("", config=True,
+                               help="Kernel spec of the pooled kernels (default: the default kernel).")
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._pool = []  # ready kernels, not handed out yet
+        self._pool_filling = 0  # kernels being started for the pool
+        self.kernel_startup = {}  # kernel_id -> (seconds, from pool)
+        self.startup_latencies = collections.deque(maxlen=100)
+
+    @property
+    def _pool_name(self):
+        return self.pool_kernel_name or self.default_kernel_name
+
+    def fill_pool(self):
+        '''Start kernels in the background until the pool is full'''
+
+        missing = self.pool_size - len(self._pool) - self._pool_filling
+        for _ in range(max(missing, 0)):
+            self._pool_filling += 1
+            asyncio.ensure_future(self._start_pool_kernel())
+
+    async def _start_pool_kernel(self):
+        try:
+            kernel_id = await super().start_kernel(kernel_name=self._pool_name)
+            await self.get_kernel(kernel_id).ready
+        except Exception:
+            self.log.exception("Could not start a pooled kernel")
+            return
+        finally:
+            self._pool_filling -= 1
+        self._pool.append(kernel_id)
+        self.log.info("Pooled kernel %s is ready", kernel_id)
+
+    async def _run_in_kernel(self, kernel_id, code, timeout=10):
+        '''Silently execute CODE in a kernel and wait for the reply'''
+
+        client = self.get_kernel(kernel_id).client()
+        client.start_channels()
+        try:
+            msg_id = client.execute(code, silent=True, store_history=False)
+            while True:
+                reply = await client.get_shell_msg(timeout=timeout)
+                if reply["parent_header"].get("msg_id") == msg_id:
+                    return reply
+        finally:
+            client.stop_channels()
+
+    async def _claim_pool_kernel(self, path, env):
+        '''Hand out a pooled kernel set up for PATH and ENV, or None
+
+        Pooled kernels start in the root dir, without the session's
+        environment: move them to the notebook's dir, copy the variables
+        that differ from the server's (e.g. JPY_SESSION_NAME) into
+        os.environ, and set __session__ as ipykernel would. Variables only
+        read at interpreter startup cannot take effect this way. The launch
+        arguments are updated too, so that a restart relaunches the kernel
+        like a session kernel. If the setup fails, the kernel is shut down
+        and None is returned.
+        '''
+
+        kernel_id = self._pool.pop(0)
+        cwd = self.cwd_for_path(path) if path else self.root_dir
+        session_env = env or {}
+        env = {name: value for name, value in session_env.items()
+               if os.environ.get(name) != value}
+        code = f"import os; os.chdir({cwd!r}); os.environ.update({env!r})"
+        if env.get("JPY_SESSION_NAME"):
+            code += (f"; get_ipython().user_ns['__session__'] = "
+                     f"{env['JPY_SESSION_NAME']!r}")
+        try:
+            reply = await self._run_in_kernel(kernel_id, code + "; del os")
+            if reply["content"]["status"] != "ok":
+                raise RuntimeError(reply["content"].get("evalue"))
+        except Exception:
+            self.log.exception("Could not set up pooled kernel %s", kernel_id)
+            try:
+                await self.shutdown_kernel(kernel_id, now=True)
+            except Exception:
+                self.log.exception("Could not shut down kernel %s", kernel_id)
+            return None
+        kernel = self.get_kernel(kernel_id)
+        kernel.last_activity = datetime.datetime.now(datetime.timezone.utc)
+        # restart_kernel() relaunches with the saved start_kernel() arguments
+        launch_args = kernel._launch_args
+        launch_args["cwd"] = cwd
+        launch_args["env"] = {**launch_args.get("env", os.environ),
+                              **session_env}
+        return kernel_id
+
+    async def start_kernel(self, *, kernel_id=None, path=None, **kwargs):
+        started = time.monotonic()
+        kernel_name = kwargs.get("kernel_name") or self.default_kernel_name
+        pooled_id = None
+        if kernel_id is None and self._pool and kernel_name == self._pool_name:
+            pooled_id = await self._claim_pool_kernel(path, kwargs.get("env"))
+
+        if pooled_id is not None:
+            kernel_id = pooled_id
+            self._record_startup(kernel_id, started, pooled=True)
+            self.log.info("Handed out pooled kernel %s", kernel_id)
+        else:
+            kernel_id = await super().start_kernel(kernel_id=kernel_id,
+                                                   path=path, **kwargs)
+            asyncio.ensure_future(self._wait_for_startup(kernel_id, started))
+        self.fill_pool()
+        return kernel_id
+
+    async def _wait_for_startup(self, kernel_id, started):
+        try:
+            await self.get_kernel(kernel_id).ready
+        except Exception:
+            return
+        self._record_startup(kernel_id, started, pooled=False)
+
+    def _record_startup(self, kernel_id, started, pooled):
+        seconds = time.monotonic() - started
+        self.kernel_startup[kernel_id] = (seconds, pooled)
+        self.startup_latencies.append(seconds)
+
+    def list_kernels(self):
+        # pooled kernels are not visible until they are handed out
+        return [model for model in super().list_kernels()
+                if model["id"] not in self._pool]
+
+    async def cull_kernel_if_idle(self, kernel_id):
+        if kernel_id in self._pool:
+            return
+        return await super().cull_kernel_if_idle(kernel_id)
+
+    async def shutdown_kernel(self, kernel_id, now=False, restart=False):
+        if kernel_id in self._pool:
+            self._pool.remove(kernel_id)
+        self.kernel_startup.pop(kernel_id, None)
+        return await super().shutdown_kernel(kernel_id, now=now,
+                                             restart=restart)
+
+
+def kernel_rss(kernel):
+    '''Resident memory of a local kernel process in bytes, or None'''
+
+    pid = getattr(kernel.provisioner, "pid", None)
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class KernelMetricsHandler(APIHandler):
+    '''Serve kernel memory and startup latency metrics as JSON'''
+
+    @web.authenticated
+    def get(self):
+        manager = self.kernel_manager
+        pool = getattr(manager, "_pool", [])
+        startup = getattr(manager, "kernel_startup", {})
+        latencies = list(getattr(manager, "startup_latencies", []))
+
+        kernels = []
+        for kernel_id in manager.list_kernel_ids():
+            kernel = manager.get_kernel(kernel_id)
+            seconds, pooled = startup.get(kernel_id, (None, None))
+            kernels.append({
+                "id": kernel_id,
+                "name": kernel.kernel_name,
+                "execution_state": getattr(kernel, "execution_state", None),
+                "pooled": kernel_id in pool,
+                "rss_bytes": kernel_rss(kernel),
+                "startup_seconds": seconds,
+                "started_from_pool": pooled,
+            })
+
+        self.finish(json.dumps({
+            "kernels": kernels,
+            "rss_bytes_total": sum(k["rss_bytes"] or 0 for k in kernels),
+            "pool": {"size": getattr(manager, "pool_size", 0),
+                     "ready": len(pool)},
+            "startup_latency_seconds": {
+                "samples": len(latencies),
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+                "max": max(latencies, default=None),
+                "last": latencies[-1] if latencies else None,
+            },
+        }))
+
+
+def _jupyter_server_extension_points():
+    return [{"module": "homl3_kernels"}]
+
+
+def _load_jupyter_server_extension(serverapp):
+    route = url_path_join(serverapp.base_url, "/homl3/metrics")
+    serverapp.web_app.add_handlers(".*$", [(route, KernelMetricsHandler)])
+    if isinstance(serverapp.kernel_manager, PooledKernelManager):
+        IOLoop.current().add_callback(serverapp.kernel_manager.fill_pool)
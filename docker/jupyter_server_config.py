@@ -0,0 +1,23 @@
+# Kernel management for the shared container, tuned with the HOML3_*
+# environment variables set in docker-compose.yml (see docker/README.md)
+
+import os
+
+c = get_config()  # noqa: F821
+
+
+def env_int(name, default):
+    return int(os.environ.get(name) or default)
+
+
+# pre-started kernel pool and /homl3/metrics endpoint
+c.ServerApp.kernel_manager_class = "homl3_kernels.PooledKernelManager"
+c.ServerApp.jpserver_extensions = {"homl3_kernels": True}
+c.PooledKernelManager.pool_size = env_int("HOML3_KERNEL_POOL_SIZE", 1)
+
+# shut down kernels idle for HOML3_CULL_IDLE_TIMEOUT seconds (0: never), even
+# if a forgotten browser tab is still connected to them
+c.MappingKernelManager.cull_idle_timeout = env_int("HOML3_CULL_IDLE_TIMEOUT", 3600)
+c.MappingKernelManager.cull_interval = env_int("HOML3_CULL_INTERVAL", 300)
+c.MappingKernelManager.cull_connected = True
+c.MappingKernelManager.cull_busy = False
@@ -16,20 +16,36 @@ Email: richard.jie.cui@gmail.com
 DOWNLOAD_ROOT_OLD = "http://raw.githubusercontent.com/ageron/handson-ml2/master/" # 2nd Edition
 DOWNLOAD_ROOT = "https://github.com/ageron/data/raw/main/" # 3rd Edition
 HOML3_ROOT = "https://github.com/ageron/handson-ml3/raw/main/"
+BUNDLE_MAGIC = b"HOML3BDL" # data bundle file signature
+BUNDLE_VERSION = 1
+CALIFORNIA_EXTENT = (-124.55, -113.95, 32.45, 42.05) # lon/lat of california.png
+INCOME_BINS = [0., 1.5, 3.0, 4.5, 6., float("inf")] # income_cat strata
+MNIST_SHIFTS = ((0, 0), (1, 0), (-1, 0), (0, 1), (0, -1)) # original + 4 shifts
 
 # ==========================================================================
 # Libraries
 # ==========================================================================
+import asyncio
+import functools
+import io
+import json
+import mmap
+import struct
 import tarfile
+import tempfile
 import sys
 import sklearn
 import os
 import shutil
 import matplotlib.pyplot as plt
 import urllib.request
+import numpy as np
 import pandas as pd
 import joblib
+from joblib import Parallel, delayed
+from scipy.ndimage import gaussian_filter
 from sklearn.datasets import fetch_openml
+from sklearn.utils import Bunch
 
 # check system requirements
 # Python ≥ 3.5 is required
@@ -195,6 +211,241 @@ def download_california_image():
     url = HOML3_ROOT+"images/end_to_end_project/"+filename
     urllib.request.urlretrieve(url, os.path.join(imagepath, filename))
 
+# Chapter 2: Aggregate housing data on a geographic grid
+def bin_housing_grid(housing, value="median_house_value", statistic="mean",
+                     resolution=(256, 256), extent=CALIFORNIA_EXTENT,
+                     chunksize=100_000):
+    '''Aggregate districts into a 2-D longitude/latitude grid
+
+    HOUSING is a DataFrame, a CSV path or an iterable of DataFrames (see
+    _iter_housing_chunks()). Points are binned chunk by chunk with
+    np.histogram2d() into RESOLUTION (longitude, latitude) cells (or
+    RESOLUTION x RESOLUTION cells if it is an int) covering EXTENT, so
+    memory only depends on the grid and the chunk size. STATISTIC is
+    "count", "sum" or "mean" of the VALUE column.
+
+    Rows whose VALUE is NaN are ignored by "sum" and "mean" (but counted by
+    "count"). Returns a (latitude, longitude) array, ready for imshow() with
+    origin="lower", where cells without any known value are NaN (0 for
+    "count").
+    '''
+
+    if statistic not in ("count", "sum", "mean"):
+        raise ValueError(f"Unknown statistic '{statistic}'")
+    if np.isscalar(resolution):
+        resolution = (resolution, resolution)
+    if isinstance(housing, pd.DataFrame):
+        housing = [housing]
+    elif isinstance(housing, (str, os.PathLike)):
+        housing = _iter_housing_chunks(housing, chunksize)
+
+    # count every point for "count", only those with a known VALUE otherwise
+    range_ = [extent[:2], extent[2:]]
+    counts = np.zeros(resolution)
+    sums = np.zeros(resolution)
+    for chunk in housing:
+        lon = chunk["longitude"].to_numpy()
+        lat = chunk["latitude"].to_numpy()
+        if statistic == "count":
+            counts += np.histogram2d(lon, lat, bins=resolution,
+                                     range=range_)[0]
+            continue
+        weights = chunk[value].to_numpy(dtype=float)
+        known = ~np.isnan(weights)
+        counts += np.histogram2d(lon[known], lat[known], bins=resolution,
+                                 range=range_)[0]
+        sums += np.histogram2d(lon[known], lat[known], bins=resolution,
+                               range=range_, weights=weights[known])[0]
+
+    if statistic == "count":
+        grid = counts
+    elif statistic == "sum":
+        grid = np.where(counts > 0, sums, np.nan)
+    else:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            grid = np.where(counts > 0, sums / counts, np.nan)
+    return grid.T
+
+# Chapter 2: Plot aggregated housing data over the California map
+def plot_housing_grid(housing, value="median_house_value", statistic="mean",
+                      resolution=(256, 256), extent=CALIFORNIA_EXTENT,
+                      cmap="jet", alpha=0.6, ax=None, chunksize=100_000):
+    '''Render housing data as one binned image layer over California
+
+    Same idea as the Chapter 2 scatter plot over read_california_image(),
+    but the points are first aggregated with bin_housing_grid(), so the
+    rendering cost depends on RESOLUTION instead of the number of rows.
+    Returns the image layer, e.g. for plt.colorbar().
+    '''
+
+    grid = bin_housing_grid(housing, value, statistic, resolution, extent,
+                            chunksize)
+    if statistic == "count":
+        grid = np.where(grid > 0, grid, np.nan)
+
+    if ax is None:
+        ax = plt.gca()
+    ax.imshow(read_california_image(), extent=extent)
+    layer = ax.imshow(np.ma.masked_invalid(grid), extent=extent,
+                      origin="lower", cmap=cmap, alpha=alpha,
+                      interpolation="nearest")
+    ax.set_xlabel("Longitude")
+    ax.set_ylabel("Latitude")
+    ax.set_aspect("auto")
+    return layer
+
+# Chapter 2: Iterate over housing data in chunks
+def _iter_housing_chunks(source=None, chunksize=100_000):
+    '''Iterate over a housing data source as DataFrame chunks
+
+    SOURCE is a CSV path (default: the housing.csv used by
+    load_housing_data()), or any iterable of DataFrames.
+    '''
+
+    if source is None:
+        source = os.path.join(get_data_root(), "housing", "housing.csv")
+    if isinstance(source, (str, os.PathLike)):
+        with pd.read_csv(source, chunksize=chunksize) as reader:
+            yield from reader
+    else:
+        yield from source
+
+# Chapter 2: Assign housing rows to income strata
+def _income_strata(chunk, stratify_on="median_income", bins=INCOME_BINS):
+    '''Return the income_cat stratum (1, 2, ...) of every row of CHUNK'''
+
+    labels = list(range(1, len(bins)))
+    return pd.cut(chunk[stratify_on], bins=bins, labels=labels)
+
+# Chapter 2: Compare stratum proportions
+def _strata_proportions(counts):
+    '''Turn a dict of per-stratum count Series into a % comparison table'''
+
+    report = pd.DataFrame(counts).fillna(0).sort_index()
+    report.index.name = "income_cat"
+    report = report / report.sum() * 100
+    report.columns = [f"{name} %" for name in report.columns]
+    return report
+
+# Chapter 2: Stratified split of a large housing extract
+def split_housing_stream(output_dir, source=None, test_ratio=0.2,
+                         id_columns=None, stratify_on="median_income",
+                         bins=INCOME_BINS, chunksize=100_000, seed=42):
+    '''Stratified train/test split of housing data in one streaming pass
+
+    Rows are read CHUNKSIZE at a time from SOURCE (see
+    _iter_housing_chunks()) and each one goes to the test set if the hash of
+    its ID_COLUMNS (default: all columns) falls below TEST_RATIO, as with
+    is_id_in_test_set() in Chapter 2. The assignment depends only on the row
+    and SEED, so it is reproducible, stable when new rows are appended, and
+    independent of CHUNKSIZE, and only the current chunk is held in memory.
+    The stratification is approximate: every row of every income stratum
+    goes to the test set with the same probability, so each stratum gets
+    TEST_RATIO of its rows on average, but small strata can be off by a few
+    percentage points (use the returned report to check).
+
+    Each chunk is written as a pair of shards train_NNNNN.csv and
+    test_NNNNN.csv in OUTPUT_DIR, and the shards are listed in
+    OUTPUT_DIR/shards.json. Running the split again only removes the shards
+    listed there, and raises FileExistsError rather than overwrite any other
+    file. Returns a DataFrame comparing the stratum proportions of the full
+    population, the train and the test sets.
+    '''
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_file = os.path.join(output_dir, "shards.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as manifest:
+            for old_shard in json.load(manifest):
+                old_path = os.path.join(output_dir, old_shard)
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+        os.remove(manifest_file)
+
+    hash_key = f"{seed % 10**16:016d}"
+    counts = {name: pd.Series(dtype="int64")
+              for name in ("Overall", "Train", "Test")}
+    shards = []
+    for i, chunk in enumerate(_iter_housing_chunks(source, chunksize)):
+        ids = chunk if id_columns is None else chunk[id_columns]
+        hashes = pd.util.hash_pandas_object(ids, index=False,
+                                            hash_key=hash_key).to_numpy()
+        in_test = (hashes >> np.uint64(11)) / 2**53 < test_ratio
+        strata = _income_strata(chunk, stratify_on, bins)
+
+        for name, rows in (("train", chunk[~in_test]),
+                           ("test", chunk[in_test])):
+            shard = f"{name}_{i:05d}.csv"
+            shard_path = os.path.join(output_dir, shard)
+            if os.path.exists(shard_path):
+                raise FileExistsError(f"'{shard_path}' was not written by "
+                                      "split_housing_stream()")
+            rows.to_csv(shard_path, index=False)
+            shards.append(shard)
+        with open(manifest_file, "w") as manifest:
+            json.dump(shards, manifest)
+        for name, mask in (("Overall", slice(None)), ("Train", ~in_test),
+                           ("Test", in_test)):
+            counts[name] = counts[name].add(strata[mask].value_counts(),
+                                            fill_value=0)
+
+    return _strata_proportions(counts)
+
+# Chapter 2: Stratified sample of a large housing extract
+def sample_housing_stream(sample_size, source=None,
+                          stratify_on="median_income", bins=INCOME_BINS,
+                          chunksize=100_000, seed=42):
+    '''Proportionally stratified random sample of housing data
+
+    Keeps a reservoir of up to SAMPLE_SIZE random rows per income stratum
+    while streaming SOURCE (see _iter_housing_chunks()) once, so memory is
+    bounded by the number of strata times SAMPLE_SIZE whatever the size of
+    the extract. Once the stratum sizes are known, each stratum contributes
+    its share of SAMPLE_SIZE rows, taken from its (uniformly random)
+    reservoir.
+
+    Returns the sample, and a DataFrame comparing its stratum proportions
+    with those of the full population.
+    '''
+
+    rng = np.random.default_rng(seed)
+    reservoirs = {}
+    population = pd.Series(dtype="int64")
+    for chunk in _iter_housing_chunks(source, chunksize):
+        strata = _income_strata(chunk, stratify_on, bins)
+        for stratum, rows in chunk.groupby(strata, observed=True):
+            seen = population.get(stratum, 0)
+            reservoir = reservoirs.get(stratum, rows.iloc[:0])
+
+            # fill the reservoir, then replace rows with Algorithm R odds
+            n_fill = min(sample_size - len(reservoir), len(rows))
+            reservoir = pd.concat([reservoir, rows.iloc[:n_fill]])
+            positions = seen + n_fill + np.arange(len(rows) - n_fill)
+            slots = (rng.random(len(positions)) * (positions + 1)).astype(
+                np.int64)
+            replaced = slots < sample_size
+            if replaced.any():
+                # the last candidate drawn for a slot wins, as in sequential R
+                slots, winners = slots[replaced], np.flatnonzero(replaced)
+                last = len(slots) - 1 - np.unique(slots[::-1],
+                                                  return_index=True)[1]
+                order = np.arange(len(reservoir))
+                order[slots[last]] = len(reservoir) + winners[last]
+                reservoir = pd.concat(
+                    [reservoir, rows.iloc[n_fill:]]).iloc[order]
+            reservoirs[stratum] = reservoir
+            population.loc[stratum] = seen + len(rows)
+
+    allocation = (population / population.sum() * sample_size).round()
+    sample = pd.concat([
+        reservoirs[stratum].iloc[rng.permutation(len(reservoirs[stratum]))]
+        .iloc[:int(allocation[stratum])]
+        for stratum in population.index])
+    sample_strata = _income_strata(sample, stratify_on, bins)
+    report = _strata_proportions({
+        "Overall": population, "Sample": sample_strata.value_counts()})
+    return sample, report
+
 # ==========================================================================
 # Chapter 3
 # ==========================================================================
@@ -226,5 +477,562 @@ def download_mnist_data():
     minst_file = os.path.join(datapath, f"{filename}.joblib")
     mnist = fetch_openml(filename, version=1, as_frame=False, parser='pandas')
     joblib.dump(mnist, minst_file)
-                               
+
+# Chapter 3: Warp a batch of images
+def _warp_images(images, rows, cols):
+    '''Sample a batch of images at the source coordinates (rows, cols)
+
+    IMAGES is (n, height, width); ROWS and COLS are float arrays of the same
+    shape giving, for every output pixel, where to read it in the input.
+    Bilinear interpolation is done with vectorized fancy indexing over the
+    whole batch, and pixels falling outside the image are set to 0. Integer
+    coordinates (pure shifts) are copied exactly.
+    '''
+
+    n, height, width = images.shape
+    row0 = np.floor(rows).astype(np.intp)
+    col0 = np.floor(cols).astype(np.intp)
+    frac_row = (rows - row0).astype(np.float32)
+    frac_col = (cols - col0).astype(np.float32)
+    batch = np.arange(n)[:, None, None]
+
+    warped = np.zeros(rows.shape, dtype=np.float32)
+    for d_row, d_col, weight in (
+            (0, 0, (1 - frac_row) * (1 - frac_col)),
+            (0, 1, (1 - frac_row) * frac_col),
+            (1, 0, frac_row * (1 - frac_col)),
+            (1, 1, frac_row * frac_col)):
+        src_row = row0 + d_row
+        src_col = col0 + d_col
+        inside = ((src_row >= 0) & (src_row < height)
+                  & (src_col >= 0) & (src_col < width))
+        pixels = images[batch, np.clip(src_row, 0, height - 1),
+                        np.clip(src_col, 0, width - 1)]
+        warped += np.where(inside, pixels * weight, 0)
+    return warped
+
+# Chapter 3: Augment a chunk of MNIST images
+def _augment_mnist_chunk(X, shifts, max_angle, elastic_alpha, elastic_sigma,
+                         seed, image_shape=(28, 28)):
+    '''Augment one chunk of flattened images with every shift in SHIFTS
+
+    Returns an array of shape (len(shifts), n, height * width) with the same
+    dtype as X. The random rotation and elastic displacement of each image
+    are drawn once per shift from SEED, folded into a single source
+    coordinate map together with the shift, and applied in one sampling
+    pass.
+    '''
+
+    height, width = image_shape
+    images = np.asarray(X, dtype=np.float32).reshape(-1, height, width)
+    n = len(images)
+    rng = np.random.default_rng(seed)
+    grid_row, grid_col = np.mgrid[0:height, 0:width].astype(np.float32)
+    center_row, center_col = (height - 1) / 2, (width - 1) / 2
+
+    augmented = np.empty((len(shifts), n, height * width), dtype=X.dtype)
+    for i, (dx, dy) in enumerate(shifts):
+        rows = np.broadcast_to(grid_row - dy, (n, height, width))
+        cols = np.broadcast_to(grid_col - dx, (n, height, width))
+        if max_angle:
+            angles = np.deg2rad(rng.uniform(-max_angle, max_angle, n))
+            cos = np.cos(angles)[:, None, None]
+            sin = np.sin(angles)[:, None, None]
+            rel_row, rel_col = rows - center_row, cols - center_col
+            rows = center_row + cos * rel_row - sin * rel_col
+            cols = center_col + sin * rel_row + cos * rel_col
+        if elastic_alpha:
+            d_rows, d_cols = (
+                elastic_alpha * gaussian_filter(
+                    rng.uniform(-1, 1, (n, height, width)),
+                    sigma=(0, elastic_sigma, elastic_sigma), mode="constant")
+                for _ in range(2))
+            rows = rows + d_rows
+            cols = cols + d_cols
+        warped = _warp_images(images, rows, cols).reshape(n, -1)
+        if np.issubdtype(X.dtype, np.integer):
+            warped = np.rint(warped)
+        augmented[i] = warped
+    return augmented
+
+# Chapter 3: Write an augmented chunk of MNIST images to a .npy file
+def _augment_mnist_chunk_to_file(filename, X, start, n_total, shifts,
+                                 max_angle, elastic_alpha, elastic_sigma,
+                                 seed):
+    '''Augment one chunk and write it in place into the .npy FILENAME'''
+
+    augmented = _augment_mnist_chunk(X, shifts, max_angle, elastic_alpha,
+                                     elastic_sigma, seed)
+    X_out = np.load(filename, mmap_mode="r+")
+    for i in range(len(shifts)):
+        offset = i * n_total + start
+        X_out[offset:offset + len(X)] = augmented[i]
+    X_out.flush()
+    del X_out
+
+# Chapter 3: Augment MNIST images batch by batch
+def augment_mnist_batches(X, y, shifts=MNIST_SHIFTS, max_angle=0.,
+                          elastic_alpha=0., elastic_sigma=4.,
+                          batch_size=4096, n_jobs=1, random_state=None):
+    '''Yield augmented (X_batch, y_batch) pairs from MNIST arrays
+
+    X is (n, 784) as in load_mnist_data().data and y the matching labels.
+    Each image is shifted by every (dx, dy) pixel offset in SHIFTS (positive
+    dx moves the digit right, positive dy moves it down; the default gives
+    the 5x training set of the Chapter 3 exercise). When MAX_ANGLE (degrees)
+    is set, every copy is also rotated by a random angle in [-MAX_ANGLE,
+    MAX_ANGLE], and when ELASTIC_ALPHA is set, it is elastically distorted
+    by a random displacement field smoothed with a Gaussian of width
+    ELASTIC_SIGMA pixels.
+
+    Images are processed BATCH_SIZE at a time with vectorized indexing, and
+    each yielded batch holds the len(SHIFTS) copies of one input batch, in
+    the same order as SHIFTS. With N_JOBS > 1 the batches are computed in
+    parallel by joblib workers, but are still yielded in order. Results are
+    reproducible for a given RANDOM_STATE and BATCH_SIZE.
+    '''
+
+    X = np.asarray(X)
+    y = np.asarray(y)
+    starts = range(0, len(X), batch_size)
+    seeds = np.random.SeedSequence(random_state).spawn(len(starts))
+
+    chunks = Parallel(n_jobs=n_jobs, return_as="generator")(
+        delayed(_augment_mnist_chunk)(X[start:start + batch_size], shifts,
+                                      max_angle, elastic_alpha,
+                                      elastic_sigma, seed)
+        for start, seed in zip(starts, seeds))
+    for start, augmented in zip(starts, chunks):
+        y_batch = y[start:start + batch_size]
+        yield (augmented.reshape(-1, augmented.shape[-1]),
+               np.tile(y_batch, len(shifts)))
+
+# Chapter 3: Augment MNIST images into a memory-mapped array
+def augment_mnist_to_memmap(X, y, filename, shifts=MNIST_SHIFTS, max_angle=0.,
+                            elastic_alpha=0., elastic_sigma=4.,
+                            batch_size=4096, n_jobs=1, random_state=None):
+    '''Augment MNIST arrays straight into the .npy file FILENAME
+
+    Takes the same augmentation arguments as augment_mnist_batches(), but
+    instead of yielding batches, each worker writes its chunk directly into
+    a memory-mapped output of shape (len(SHIFTS) * n, 784), so the augmented
+    training set never has to fit in memory. Row k * n + i holds image i
+    shifted by SHIFTS[k], which is the order of the Chapter 3 exercise.
+
+    Returns the output opened read-only with mmap_mode="r", and the matching
+    labels.
+    '''
+
+    X = np.asarray(X)
+    y = np.asarray(y)
+    n_total = len(X)
+    X_out = np.lib.format.open_memmap(
+        filename, mode="w+", dtype=X.dtype,
+        shape=(len(shifts) * n_total, X.shape[1]))
+    del X_out
+
+    starts = range(0, n_total, batch_size)
+    seeds = np.random.SeedSequence(random_state).spawn(len(starts))
+    Parallel(n_jobs=n_jobs)(
+        delayed(_augment_mnist_chunk_to_file)(
+            filename, X[start:start + batch_size], start, n_total, shifts,
+            max_angle, elastic_alpha, elastic_sigma, seed)
+        for start, seed in zip(starts, seeds))
+
+    return np.load(filename, mmap_mode="r"), np.tile(y, len(shifts))
+
+# ==========================================================================
+# Data bundle
+# ==========================================================================
+# Bundle layout: a 24-byte preamble (BUNDLE_MAGIC, version, reserved, index
+# length), a JSON index, then every member, uncompressed, at an offset
+# aligned on ALIGNMENT bytes. Member offsets in the index are relative to
+# the (aligned) start of the data section. Members are
+#   "array": raw C-ordered array with "dtype" and "shape",
+#   "table": CSV bytes, parsed on demand,
+#   "raw":   any other file, as bytes.
+
+# get default data bundle path
+def get_bundle_path():
+    '''Get default data bundle path, next to the data root'''
+
+    return os.path.join(os.path.dirname(get_data_root()), "homl3_data.bundle")
+
+# Round up to a multiple of the alignment
+def _align(offset, alignment):
+    '''Round OFFSET up to a multiple of ALIGNMENT'''
+
+    return -(-offset // alignment) * alignment
+
+# Pack all book datasets into one bundle file
+def pack_data_bundle(bundle_file=None, data_root=None, image_root=None,
+                     images=("end_to_end_project/california.png",),
+                     alignment=4096):
+    '''Pack the data/ tree (and a few images) into a single bundle file
+
+    Every file under DATA_ROOT becomes a member named by its path relative
+    to DATA_ROOT (e.g. "housing/housing.csv"): CSV files are stored as
+    tables, and everything else (e.g. housing.tgz) as raw bytes. A .joblib
+    file holding a dict (e.g. the MNIST Bunch) is split instead: its arrays
+    become array members named "<path>/<key>" (e.g.
+    "mnist/mnist_784.joblib/data"), and its other JSON-serializable fields
+    (e.g. feature_names, DESCR) are kept in the index metadata under
+    "<path>". Any other .joblib file (e.g. a saved model) is stored raw.
+    The IMAGES, relative to IMAGE_ROOT, are decoded with plt.imread() and
+    stored as arrays under "images/<path>". Object arrays (e.g. the MNIST
+    labels) are stored as fixed-width strings.
+
+    The bundle is written to a temporary file next to BUNDLE_FILE, then
+    moved onto it, so processes that still map the previous bundle keep
+    reading it safely. Returns the path of the bundle file.
+    '''
+
+    bundle_file = bundle_file or get_bundle_path()
+    data_root = data_root or get_data_root()
+    image_root = image_root or get_image_root()
+
+    # collect members as (name, kind, source), source being a path or array
+    members = []
+    metadata = {}
+    for dirpath, dirnames, filenames in os.walk(data_root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            if os.path.abspath(path) == os.path.abspath(bundle_file):
+                continue
+            name = os.path.relpath(path, data_root).replace(os.sep, "/")
+            if filename.endswith(".csv"):
+                members.append((name, "table", path))
+            elif filename.endswith(".joblib"):
+                content = joblib.load(path)
+                if not isinstance(content, dict):
+                    members.append((name, "raw", path))
+                    continue
+                metadata[name] = {}
+                for key, value in content.items():
+                    if isinstance(value, np.ndarray):
+                        if value.dtype == object:
+                            value = value.astype(str)
+                        members.append((f"{name}/{key}", "array",
+                                        np.ascontiguousarray(value)))
+                    else:
+                        try:
+                            json.dumps(value)
+                        except TypeError:
+                            continue
+                        metadata[name][key] = value
+            else:
+                members.append((name, "raw", path))
+    for image in images:
+        image_array = plt.imread(os.path.join(image_root, image))
+        members.append((f"images/{image}", "array",
+                        np.ascontiguousarray(image_array)))
+
+    # lay out the members
+    index = {}
+    offset = 0
+    for name, kind, source in members:
+        entry = {"kind": kind, "offset": offset}
+        if kind == "array":
+            entry.update(size=source.nbytes, dtype=source.dtype.str,
+                         shape=list(source.shape))
+        else:
+            entry["size"] = os.path.getsize(source)
+        index[name] = entry
+        offset = _align(offset + entry["size"], alignment)
+    index_bytes = json.dumps({"alignment": alignment, "members": index,
+                              "metadata": metadata}).encode("utf-8")
+    data_start = _align(24 + len(index_bytes), alignment)
+
+    # write the bundle to a temporary file, then replace the old one with it
+    print("Packing", len(index), "members into", bundle_file)
+    fd, tmp_file = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(bundle_file)),
+        prefix=os.path.basename(bundle_file) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as bundle:
+            _write_bundle(bundle, members, index, index_bytes, data_start,
+                          data_start + offset)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_file, 0o666 & ~umask)  # mkstemp() makes it private
+        os.replace(tmp_file, bundle_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    return bundle_file
+
+# Write the bundle members to a file
+def _write_bundle(bundle, members, index, index_bytes, data_start, size):
+    '''Write the preamble, index and MEMBERS laid out by pack_data_bundle()'''
+
+    bundle.write(struct.pack("<8sIIQ", BUNDLE_MAGIC, BUNDLE_VERSION, 0,
+                             len(index_bytes)))
+    bundle.write(index_bytes)
+    for name, kind, source in members:
+        bundle.seek(data_start + index[name]["offset"])
+        if kind == "array":
+            bundle.write(memoryview(source).cast("B"))
+        else:
+            with open(source, "rb") as member_file:
+                shutil.copyfileobj(member_file, bundle)
+    bundle.truncate(size)
+
+# Memory-mapped data bundle
+class DataBundle:
+    '''Read-only, memory-mapped view of a bundle built by pack_data_bundle()
+
+    Array members are returned as zero-copy, read-only NumPy views on the
+    mapping, and table members as CSV byte ranges parsed on demand. After
+    close(), the bundle can no longer be read, and the file is unmapped at
+    once, or as soon as the last view on it is gone.
+    '''
+
+    def __init__(self, bundle_file=None):
+        self.bundle_file = bundle_file or get_bundle_path()
+        with open(self.bundle_file, "rb") as bundle:
+            self._mmap = mmap.mmap(bundle.fileno(), 0, access=mmap.ACCESS_READ)
+            self._file_id = _file_id(os.fstat(bundle.fileno()))
+        magic, version, _, index_length = struct.unpack_from("<8sIIQ",
+                                                             self._mmap)
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            self._mmap.close()
+            raise ValueError(f"'{self.bundle_file}' is not a version "
+                             f"{BUNDLE_VERSION} data bundle")
+        header = json.loads(self._mmap[24:24 + index_length])
+        self.members = header["members"]
+        self.metadata = header.get("metadata", {})
+        self._data_start = _align(24 + index_length, header["alignment"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.members
+
+    @property
+    def closed(self):
+        return self._mmap is None
+
+    def is_stale(self):
+        '''Tell whether the bundle file was replaced since it was opened'''
+
+        try:
+            return _file_id(os.stat(self.bundle_file)) != self._file_id
+        except OSError:
+            return True
+
+    def close(self):
+        '''Close the bundle, unmapping it once no view on it is left'''
+
+        if self._mmap is None:
+            return
+        mapping, self._mmap = self._mmap, None
+        try:
+            mapping.close()
+        except BufferError:
+            # views still export the mapping: it is unmapped when they go
+            pass
+
+    def _mapping(self):
+        if self._mmap is None:
+            raise ValueError(f"Data bundle '{self.bundle_file}' is closed")
+        return self._mmap
+
+    def raw(self, name):
+        '''Return the bytes of member NAME as a zero-copy memoryview'''
+
+        entry = self.members[name]
+        start = self._data_start + entry["offset"]
+        return memoryview(self._mapping())[start:start + entry["size"]]
+
+    def array(self, name):
+        '''Return array member NAME as a zero-copy, read-only NumPy view'''
+
+        entry = self.members[name]
+        if entry["kind"] != "array":
+            raise ValueError(f"Bundle member '{name}' is not an array")
+        return np.frombuffer(
+            self._mapping(), dtype=np.dtype(entry["dtype"]),
+            count=int(np.prod(entry["shape"])),
+            offset=self._data_start + entry["offset"]).reshape(entry["shape"])
+
+    def table(self, name, **kwargs):
+        '''Parse table member NAME with pd.read_csv(**KWARGS)'''
+
+        entry = self.members[name]
+        if entry["kind"] != "table":
+            raise ValueError(f"Bundle member '{name}' is not a table")
+        return pd.read_csv(io.BytesIO(self.raw(name)), **kwargs)
+
+# Open data bundles, by path
+_data_bundles = {}
+
+# Identify a file version
+def _file_id(stat):
+    '''Return what changes when a file is replaced or rewritten'''
+
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+# Open a data bundle once per process
+def open_data_bundle(bundle_file=None):
+    '''Return the shared DataBundle for BUNDLE_FILE, opening it if needed
+
+    The shared bundle is reopened if it was closed, or if the file was
+    replaced since (e.g. by pack_data_bundle()); views on the previous
+    bundle stay valid.
+    '''
+
+    bundle_file = os.path.abspath(bundle_file or get_bundle_path())
+    bundle = _data_bundles.get(bundle_file)
+    if bundle is None or bundle.closed or bundle.is_stale():
+        bundle = _data_bundles[bundle_file] = DataBundle(bundle_file)
+    return bundle
+
+# Chapter 1: Load life satisfaction data from the data bundle
+def load_lifesat_from_bundle(bundle_file=None):
+    '''Load life satisfaction data for Chapter 1 from the data bundle'''
+
+    return open_data_bundle(bundle_file).table("lifesat/lifesat.csv")
+
+# Chapter 2: Load California housing data from the data bundle
+def load_housing_data_from_bundle(bundle_file=None):
+    '''Load California housing data from the data bundle'''
+
+    return open_data_bundle(bundle_file).table("housing/housing.csv")
+
+# Chapter 2: Read California image from the data bundle
+def read_california_image_from_bundle(bundle_file=None):
+    '''Read California image from the data bundle, as a zero-copy view'''
+
+    return open_data_bundle(bundle_file).array(
+        "images/end_to_end_project/california.png")
+
+# Chapter 3: Load MNIST data from the data bundle
+def load_mnist_data_from_bundle(bundle_file=None):
+    '''Load MNIST data from the data bundle
+
+    Returns a Bunch with zero-copy, read-only "data" and "target" views (the
+    labels are fixed-width strings instead of objects), plus the fields that
+    could be stored as JSON, such as "feature_names" and "DESCR". Other
+    fields of the original Bunch are missing.
+    '''
+
+    bundle = open_data_bundle(bundle_file)
+    mnist_name = "mnist/mnist_784.joblib"
+    mnist = Bunch(**bundle.metadata.get(mnist_name, {}))
+    prefix = mnist_name + "/"
+    for name in bundle.members:
+        if name.startswith(prefix):
+            mnist[name[len(prefix):]] = bundle.array(name)
+    return mnist
+
+# ==========================================================================
+# Async API
+# ==========================================================================
+# Run a blocking function in an executor
+async def _run_in_executor(func, *args, executor=None, timeout=None,
+                           **kwargs):
+    '''Await FUNC(*ARGS, **KWARGS) run in EXECUTOR, without blocking the loop
+
+    EXECUTOR defaults to the event loop's default thread pool; pass a
+    concurrent.futures.ProcessPoolExecutor to also move CSV parsing off the
+    GIL. Raises asyncio.TimeoutError after TIMEOUT seconds. On timeout or
+    cancellation the awaiting task stops at once, but a call already
+    running in a thread cannot be interrupted and finishes in the
+    background.
+    '''
+
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(executor,
+                                  functools.partial(func, *args, **kwargs))
+    return await asyncio.wait_for(future, timeout)
+
+# Chapter 1: Load life satisfaction data asynchronously
+async def aload_lifesat(executor=None, timeout=None):
+    '''Async counterpart of load_lifesat()'''
+
+    return await _run_in_executor(load_lifesat, executor=executor,
+                                  timeout=timeout)
+
+# Chapter 1: Download life satisfaction data asynchronously
+async def adownload_lifesat(executor=None, timeout=None):
+    '''Async counterpart of download_lifesat()'''
+
+    return await _run_in_executor(download_lifesat, executor=executor,
+                                  timeout=timeout)
+
+# Chapter 2: Load California housing data asynchronously
+async def aload_housing_data(executor=None, timeout=None):
+    '''Async counterpart of load_housing_data()'''
+
+    return await _run_in_executor(load_housing_data, executor=executor,
+                                  timeout=timeout)
+
+# Chapter 2: Download California housing data asynchronously
+async def adownload_housing_data(executor=None, timeout=None):
+    '''Async counterpart of download_housing_data()'''
+
+    return await _run_in_executor(download_housing_data, executor=executor,
+                                  timeout=timeout)
+
+# Chapter 2: Read California image asynchronously
+async def aread_california_image(executor=None, timeout=None):
+    '''Async counterpart of read_california_image()'''
+
+    return await _run_in_executor(read_california_image, executor=executor,
+                                  timeout=timeout)
+
+# Chapter 2: Download California image asynchronously
+async def adownload_california_image(executor=None, timeout=None):
+    '''Async counterpart of download_california_image()'''
+
+    return await _run_in_executor(download_california_image,
+                                  executor=executor, timeout=timeout)
+
+# Chapter 3: Load MNIST data asynchronously
+async def aload_mnist_data(executor=None, timeout=None):
+    '''Async counterpart of load_mnist_data()'''
+
+    return await _run_in_executor(load_mnist_data, executor=executor,
+                                  timeout=timeout)
+
+# Chapter 3: Download MNIST data asynchronously
+async def adownload_mnist_data(executor=None, timeout=None):
+    '''Async counterpart of download_mnist_data()'''
+
+    return await _run_in_executor(download_mnist_data, executor=executor,
+                                  timeout=timeout)
+
+# Async loaders by dataset name
+ASYNC_LOADERS = {
+    "lifesat": aload_lifesat,
+    "housing": aload_housing_data,
+    "california": aread_california_image,
+    "mnist": aload_mnist_data,
+}
+
+# Prefetch several datasets concurrently
+async def aprefetch_datasets(names=("lifesat", "housing", "mnist"),
+                             executor=None, timeout=None):
+    '''Load the datasets NAMES (keys of ASYNC_LOADERS) concurrently
+
+    Returns a dict mapping each name to its data. TIMEOUT (seconds) applies
+    to the whole batch; if it expires, or if any loader fails or the
+    prefetch itself is cancelled, the other pending loads are cancelled and
+    the error is raised.
+    '''
+
+    tasks = {name: asyncio.ensure_future(ASYNC_LOADERS[name](executor))
+             for name in names}
+    try:
+        await asyncio.wait_for(asyncio.gather(*tasks.values()), timeout)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    return {name: task.result() for name, task in tasks.items()}
+
 # [EOF]
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ageron_homl3 import (bin_housing_grid, load_housing_data_from_bundle,
+                          open_data_bundle, pack_data_bundle)
+
+
+def test_bin_housing_grid_ignores_nan_values():
+    housing = pd.DataFrame({
+        "longitude": [-120.1, -120.1, -116.1, -116.1],
+        "latitude": [35.1, 35.1, 40.1, 40.1],
+        "median_house_value": [10., np.nan, np.nan, np.nan],
+    })
+    extent = (-122., -114., 34., 42.)
+    counts = bin_housing_grid(housing, statistic="count", resolution=(2, 2),
+                              extent=extent)
+    sums = bin_housing_grid(housing, statistic="sum", resolution=(2, 2),
+                            extent=extent)
+    means = bin_housing_grid(housing, statistic="mean", resolution=(2, 2),
+                             extent=extent)
+
+    # grids are (latitude, longitude): [0, 0] holds [10, NaN], [1, 1] only NaN
+    np.testing.assert_array_equal(counts, [[2., 0.], [0., 2.]])
+    np.testing.assert_array_equal(sums, [[10., np.nan], [np.nan, np.nan]])
+    np.testing.assert_array_equal(means, [[10., np.nan], [np.nan, np.nan]])
+
+
+def test_bin_housing_grid_rejects_unknown_statistic():
+    def chunks():
+        raise AssertionError("data read before checking the statistic")
+        yield
+
+    with pytest.raises(ValueError):
+        bin_housing_grid(chunks(), statistic="median")
+
+
+def test_bin_housing_grid_accepts_int_resolution():
+    housing = pd.DataFrame({"longitude": [-120.], "latitude": [37.]})
+    grid = bin_housing_grid(housing, statistic="count", resolution=4)
+
+    assert grid.shape == (4, 4)
+    assert grid.sum() == 1
+
+
+def test_data_bundle_reopens_after_close_and_repack(tmp_path):
+    data_root = tmp_path / "data"
+    (data_root / "housing").mkdir(parents=True)
+    csv_file = data_root / "housing" / "housing.csv"
+    csv_file.write_text("longitude,latitude\n-120.0,37.0\n-121.0,38.0\n")
+    bundle_file = str(tmp_path / "data.bundle")
+    pack_data_bundle(bundle_file, str(data_root), images=())
+
+    with open_data_bundle(bundle_file):
+        pass
+    assert len(load_housing_data_from_bundle(bundle_file)) == 2
+
+    view = open_data_bundle(bundle_file).raw("housing/housing.csv")
+    csv_file.write_text("longitude,latitude\n-120.0,37.0\n")
+    pack_data_bundle(bundle_file, str(data_root), images=())
+    assert len(load_housing_data_from_bundle(bundle_file)) == 1
+    assert bytes(view).count(b"\n") == 3  # old mapping still readable